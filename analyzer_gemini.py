@@ -1,12 +1,15 @@
 # analyzer_gemini.py
 import os
-import json
+import random
+import threading
+import time
 from typing import Any, Dict, List, Optional
 
 from google import genai
 from google.genai import types
 
-from utils import utc_now_iso
+from tracing import span
+from utils import utc_now_iso, json_dumps, json_loads, compile_schema
 
 # --- Catálogo fijo de razones ---
 PRIMARY_REASON_ENUM = [
@@ -118,6 +121,12 @@ def _schema() -> Dict[str, Any]:
         "additionalProperties": False,
     }
 
+# validador compilado una sola vez desde el schema
+validate_analysis = compile_schema(_schema())
+
+class SchemaValidationError(ValueError):
+    pass
+
 def _flatten_messages(messages_json: Any) -> str:
     """
     Convierte mensajes en texto plano. Es defensivo porque no sabemos el shape exacto.
@@ -188,26 +197,176 @@ class GeminiAnalyzer:
             "allowed_stages": STAGE_ENUM,
         }
 
-        resp = self.client.models.generate_content(
-            model=self.model,
-            contents=[
-                types.Content(role="user", parts=[types.Part.from_text(json.dumps(user, ensure_ascii=False))])
-            ],
-            config=types.GenerateContentConfig(
-                system_instruction=system,
-                response_mime_type="application/json",
-                response_schema=self.schema,
-                temperature=0.2,
-            ),
-        )
+        with span("gemini.generate_content", model=self.model, prompt_chars=len(convo)) as sp:
+            resp = self.client.models.generate_content(
+                model=self.model,
+                contents=[
+                    types.Content(role="user", parts=[types.Part.from_text(json_dumps(user))])
+                ],
+                config=types.GenerateContentConfig(
+                    system_instruction=system,
+                    response_mime_type="application/json",
+                    response_schema=self.schema,
+                    temperature=0.2,
+                ),
+            )
+            usage = getattr(resp, "usage_metadata", None)
+            if usage is not None:
+                sp.set("prompt_tokens", getattr(usage, "prompt_token_count", None) or 0)
+                sp.set("output_tokens", getattr(usage, "candidates_token_count", None) or 0)
 
         # Devuelve texto JSON (en modo JSON)
         text = resp.text
-        data = json.loads(text)
+        data = json_loads(text)
 
         # Completa meta si faltara (por seguridad)
-        data.setdefault("meta", {})
-        data["meta"].setdefault("model", self.model)
-        data["meta"].setdefault("analysis_ts", utc_now_iso())
+        if isinstance(data, dict) and isinstance(data.get("meta", {}), dict):
+            data.setdefault("meta", {})
+            data["meta"].setdefault("model", self.model)
+            data["meta"].setdefault("analysis_ts", utc_now_iso())
+
+        # Falla acá y no más tarde en flatten_analysis_to_row
+        errors = validate_analysis(data)
+        if errors:
+            raise SchemaValidationError("; ".join(errors[:10]))
 
         return data
+
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+THROTTLE_STATUS = (429, 503)
+
+def _status_code(e: Exception) -> Optional[int]:
+    # google-genai expone .code; requests/httpx exponen .status_code o .response.status_code
+    for attr in ("code", "status_code"):
+        v = getattr(e, attr, None)
+        if isinstance(v, int):
+            return v
+    resp = getattr(e, "response", None)
+    v = getattr(resp, "status_code", None)
+    return v if isinstance(v, int) else None
+
+def _is_timeout(e: Exception) -> bool:
+    return isinstance(e, TimeoutError) or "timeout" in type(e).__name__.lower()
+
+class AdaptiveLimiter:
+    """
+    Límite de requests en vuelo con AIMD: sube +1 por ventana mientras la latencia
+    y la tasa de error están sanas, y multiplica por `decrease` ante 429/503 (o errores
+    con la tasa de error alta). Solo baja en respuestas fallidas y como mucho una vez por
+    ventana: tras un recorte se ignoran otros hasta completar tantas respuestas como el
+    límite previo al recorte (las que ya estaban en vuelo), así N
+    requests en vuelo que reciben 429 a la vez cuentan como una sola señal.
+    """
+    def __init__(self, initial: int = 2, min_limit: int = 1, max_limit: int = 16,
+                 latency_target_sec: float = 20.0, decrease: float = 0.5,
+                 max_error_rate: float = 0.2):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.latency_target = latency_target_sec
+        self.decrease = decrease
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.latency_ewma = 0.0
+        self.error_rate = 0.0
+        # respuestas completadas desde el último recorte y tamaño de esa ventana
+        self.since_cut = 0
+        self.cut_window = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait(0.5)
+            self.in_flight += 1
+
+    def wait_capacity(self):
+        """
+        Bloquea hasta que haya lugar bajo el límite sin tomarlo: los workers lo usan antes
+        de reclamar un job, así no retienen claims mientras esperan en acquire.
+        """
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait(0.5)
+
+    def release(self, latency: float, ok: Optional[bool], throttled: bool = False):
+        """
+        `ok=None` es un resultado neutro (respuesta fuera de schema): libera el lugar sin
+        tocar latencia, tasa de error ni el límite.
+        """
+        with self.cond:
+            self.in_flight -= 1
+            self.since_cut += 1
+            if ok is None:
+                self.cond.notify_all()
+                return
+            self.latency_ewma = latency if not self.latency_ewma else 0.8 * self.latency_ewma + 0.2 * latency
+            self.error_rate = 0.9 * self.error_rate + 0.1 * (0.0 if ok else 1.0)
+
+            if not ok and (throttled or self.error_rate > self.max_error_rate):
+                if self.since_cut >= self.cut_window:
+                    self.cut_window = int(self.limit)
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.since_cut = 0
+            elif ok and latency <= self.latency_target and self.error_rate <= self.max_error_rate:
+                # additive increase: ~ +1 cada `limit` respuestas sanas
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency_ewma_sec": round(self.latency_ewma, 3),
+                "error_rate": round(self.error_rate, 3),
+            }
+
+class AdaptiveGeminiAnalyzer:
+    """
+    Envuelve GeminiAnalyzer con AdaptiveLimiter + retries con backoff exponencial y jitter,
+    así un 429/timeout no cuesta un intento completo del job.
+    """
+    def __init__(self, analyzer: GeminiAnalyzer, limiter: AdaptiveLimiter,
+                 max_retries: int = 4, backoff_base_sec: float = 1.0, backoff_max_sec: float = 30.0):
+        self.analyzer = analyzer
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base_sec
+        self.backoff_max = backoff_max_sec
+
+    @property
+    def model(self) -> str:
+        return self.analyzer.model
+
+    def analyze(self, job: Dict[str, Any], messages_json: Any) -> Dict[str, Any]:
+        attempt = 0
+        while True:
+            with span("gemini.attempt", attempt=attempt, limit=int(self.limiter.limit)) as sp:
+                self.limiter.acquire()
+                t0 = time.monotonic()
+                try:
+                    data = self.analyzer.analyze(job, messages_json)
+                except Exception as e:
+                    code = _status_code(e)
+                    # una respuesta fuera de schema no es señal de capacidad ni de salud: resultado
+                    # neutro para el limiter, y suele salir bien al reintentar
+                    malformed = isinstance(e, SchemaValidationError)
+                    self.limiter.release(time.monotonic() - t0, ok=None if malformed else False,
+                                         throttled=code in THROTTLE_STATUS)
+                    retryable = code in RETRYABLE_STATUS or _is_timeout(e) or malformed
+                    if not retryable or attempt >= self.max_retries:
+                        raise
+                    sp.set("error_status", code or 0)
+                    # full jitter
+                    backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+                    sp.set("backoff_sec", backoff)
+                    time.sleep(backoff)
+                    attempt += 1
+                    continue
+                self.limiter.release(time.monotonic() - t0, ok=True)
+                return data
+
+    def metrics(self) -> Dict[str, Any]:
+        return self.limiter.metrics()
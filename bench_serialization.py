@@ -0,0 +1,88 @@
+# bench_serialization.py
+"""
+Compara el camino de serialización anterior (json stdlib + .encode/.decode) con utils
+(orjson si está instalado, bytes end to end) sobre payloads tipo bronze/silver, y mide
+el validador compilado de analyzer_gemini.
+
+    python bench_serialization.py [n_messages] [repeats]
+"""
+import json
+import random
+import sys
+import time
+
+import utils
+
+def make_bronze(n_messages: int):
+    rnd = random.Random(42)
+    words = "hola gracias trabajo horario salario ubicación entrevista disponible mañana experiencia".split()
+    msgs = []
+    for i in range(n_messages):
+        msgs.append({
+            "id": f"msg_{i}",
+            "from": "contact" if i % 2 else "agent",
+            "text": " ".join(rnd.choice(words) for _ in range(rnd.randint(5, 40))),
+            "created_at": f"2024-05-{1 + i % 28:02d}T10:{i % 60:02d}:00Z",
+            "meta": {"channel": "whatsapp", "read": bool(i % 3), "attachments": []},
+        })
+    return {
+        "contact_key": "50212345678",
+        "maxhelper_contact_id": "123456",
+        "fetched_at": utils.utc_now_iso(),
+        "messages_raw": {"messages": msgs},
+    }
+
+def make_analysis():
+    return {
+        "applicant_id": "50212345678",
+        "contact": {"name": "Ana", "phone": "50212345678", "email": None},
+        "campaign": {"campaign_id": None, "source": "maxhelper", "channel": None},
+        "funnel": {"outcome": "applied", "stage_reached": "screening", "dropoff_stage": None},
+        "reasoning": {"primary_reason_code": "OTHER", "secondary_reason_codes": ["TIME_CONSTRAINT"], "reason_text": "..."},
+        "profile": {"skills_summary": "ventas", "skills": ["ventas", "excel"], "experience_level": "mid",
+                    "role_interest": ["ventas"], "availability": "immediate", "location": "Guatemala"},
+        "conversation": {"language": "es", "sentiment": "positive", "last_message_ts": None, "message_count": 12},
+        "quality": {"confidence": 0.8, "evidence_quotes": ["sí me interesa"], "needs_human_review": False},
+        "meta": {"model": "gemini-1.5-flash", "analysis_ts": utils.utc_now_iso()},
+    }
+
+def old_roundtrip(obj):
+    # camino anterior: json_dumps -> .encode (upload) / download -> .decode -> json.loads
+    data = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return json.loads(data.decode("utf-8")), len(data)
+
+def new_roundtrip(obj):
+    data = utils.json_dumpb(obj)
+    return utils.json_loads(data), len(data)
+
+def timeit(fn, arg, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def main():
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print(f"orjson: {'sí' if utils.orjson is not None else 'no (fallback stdlib)'}")
+
+    for label, obj in [("bronze", make_bronze(n_messages)), ("silver", make_analysis())]:
+        _, size = old_roundtrip(obj)
+        t_old = timeit(old_roundtrip, obj, repeats)
+        t_new = timeit(new_roundtrip, obj, repeats)
+        print(f"{label:7s} {size / 1024:9.1f} KiB  stdlib {t_old * 1000:8.3f} ms  utils {t_new * 1000:8.3f} ms  x{t_old / t_new:5.1f}")
+
+    try:
+        from analyzer_gemini import validate_analysis
+    except ImportError as e:
+        print(f"validación: omitida ({e})")
+        return
+    analysis = make_analysis()
+    assert not validate_analysis(analysis)
+    t = timeit(lambda a: [validate_analysis(a) for _ in range(1000)], analysis, repeats)
+    print(f"validate_analysis: {t:.3f} ms por análisis (1000 iteraciones)")
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,10 @@ ROOT_NAME = "RRHH_PIPELINE"
 SUBFOLDERS = [
   "inbox_xlsx","archive_xlsx",
   "queue_pending","queue_processing","queue_done","queue_error",
+  # colas por etapa (worker.py --stage fetch|analyze|publish)
+  "queue_fetch_pending","queue_fetch_processing","queue_fetch_done","queue_fetch_error",
+  "queue_analyze_pending","queue_analyze_processing","queue_analyze_done","queue_analyze_error",
+  "queue_publish_pending","queue_publish_processing","queue_publish_done","queue_publish_error",
   "bronze_messages_raw","silver_analysis",
   "index_files","index_contacts","index_sheet_rows",
   "logs_runs"
@@ -5,6 +5,8 @@ from googleapiclient.discovery import build
 from googleapiclient.http import MediaInMemoryUpload, MediaIoBaseDownload
 import io
 
+from tracing import span
+
 class DriveStore:
     def __init__(self, service_account_json: str):
         creds = service_account.Credentials.from_service_account_file(
@@ -20,52 +22,86 @@ class DriveStore:
         q = f"'{folder_id}' in parents and trashed=false"
         if mime_type:
             q += f" and mimeType='{mime_type}'"
-        resp = self.drive.files().list(
-            q=q,
-            fields="files(id,name,mimeType,modifiedTime,createdTime)",
-            pageSize=min(limit, 1000),
-            orderBy="createdTime asc"
-        ).execute()
-        return resp.get("files", [])
+        with span("drive.list_files", folder_id=folder_id) as sp:
+            resp = self.drive.files().list(
+                q=q,
+                fields="files(id,name,mimeType,modifiedTime,createdTime,appProperties)",
+                pageSize=min(limit, 1000),
+                orderBy="createdTime asc"
+            ).execute()
+            files = resp.get("files", [])
+            sp.set("count", len(files))
+        return files
+
+    def iter_files(self, folder_id: str, page_size: int = 100):
+        """
+        Como list_files (createdTime asc) pero recorre todas las páginas a demanda.
+        """
+        q = f"'{folder_id}' in parents and trashed=false"
+        page_token = None
+        while True:
+            with span("drive.list_files", folder_id=folder_id, paged=True) as sp:
+                resp = self.drive.files().list(
+                    q=q,
+                    fields="nextPageToken,files(id,name,mimeType,modifiedTime,createdTime,appProperties)",
+                    pageSize=min(page_size, 1000),
+                    orderBy="createdTime asc",
+                    pageToken=page_token
+                ).execute()
+                sp.set("count", len(resp.get("files", [])))
+            yield from resp.get("files", [])
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return
 
     def find_by_name(self, folder_id: str, name: str):
         q = f"'{folder_id}' in parents and trashed=false and name='{name}'"
-        resp = self.drive.files().list(
-            q=q,
-            fields="files(id,name,mimeType)"
-        ).execute()
+        with span("drive.find_by_name", folder_id=folder_id, name=name):
+            resp = self.drive.files().list(
+                q=q,
+                fields="files(id,name,mimeType)"
+            ).execute()
         files = resp.get("files", [])
         return files[0] if files else None
 
     def download_bytes(self, file_id: str) -> bytes:
-        request = self.drive.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        return fh.getvalue()
+        with span("drive.download_bytes", file_id=file_id) as sp:
+            request = self.drive.files().get_media(fileId=file_id)
+            fh = io.BytesIO()
+            downloader = MediaIoBaseDownload(fh, request)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+            data = fh.getvalue()
+            sp.set("bytes", len(data))
+        return data
 
-    def upload_json(self, folder_id: str, filename: str, json_text: str) -> str:
-        media = MediaInMemoryUpload(json_text.encode("utf-8"), mimetype="application/json")
-        file_metadata = {"name": filename, "parents": [folder_id], "mimeType": "application/json"}
-        created = self.drive.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields="id"
-        ).execute()
+    def upload_json(self, folder_id: str, filename: str, json_text: str | bytes) -> str:
+        body = json_text if isinstance(json_text, bytes) else json_text.encode("utf-8")
+        with span("drive.upload_json", folder_id=folder_id, name=filename, bytes=len(body)):
+            media = MediaInMemoryUpload(body, mimetype="application/json")
+            file_metadata = {"name": filename, "parents": [folder_id], "mimeType": "application/json"}
+            created = self.drive.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields="id"
+            ).execute()
         return created["id"]
 
-    def update_file_json(self, file_id: str, json_text: str):
-        media = MediaInMemoryUpload(json_text.encode("utf-8"), mimetype="application/json")
-        self.drive.files().update(fileId=file_id, media_body=media).execute()
+    def update_file_json(self, file_id: str, json_text: str | bytes):
+        body = json_text if isinstance(json_text, bytes) else json_text.encode("utf-8")
+        with span("drive.update_file_json", file_id=file_id, bytes=len(body)):
+            media = MediaInMemoryUpload(body, mimetype="application/json")
+            self.drive.files().update(fileId=file_id, media_body=media).execute()
 
-    def move_file(self, file_id: str, new_folder_id: str) -> None:
-        file = self.drive.files().get(fileId=file_id, fields="parents").execute()
-        previous_parents = ",".join(file.get("parents", []))
-        self.drive.files().update(
-            fileId=file_id,
-            addParents=new_folder_id,
-            removeParents=previous_parents,
-            fields="id,parents"
-        ).execute()
+    def move_file(self, file_id: str, new_folder_id: str, app_properties: Optional[dict] = None) -> None:
+        with span("drive.move_file", file_id=file_id, folder_id=new_folder_id):
+            file = self.drive.files().get(fileId=file_id, fields="parents").execute()
+            previous_parents = ",".join(file.get("parents", []))
+            self.drive.files().update(
+                fileId=file_id,
+                addParents=new_folder_id,
+                removeParents=previous_parents,
+                body={"appProperties": app_properties} if app_properties else None,
+                fields="id,parents"
+            ).execute()
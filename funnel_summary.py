@@ -0,0 +1,173 @@
+# funnel_summary.py
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from sheet_sink import APPLICANTS_COLUMNS, SheetSink
+from utils import utc_now_iso, json_dumpb, json_loads
+
+GLOBAL_SCOPE = "global"
+DIMENSIONS = ["outcome", "stage_reached", "dropoff_stage", "primary_reason_code", "needs_human_review", "confidence_bucket"]
+SUMMARY_HEADER = ["scope", "dimension", "key", "count", "updated_at"]
+
+def _confidence_bucket(v: Any) -> str:
+    try:
+        c = min(max(float(v), 0.0), 1.0)
+    except (TypeError, ValueError):
+        return "unknown"
+    lo = min(int(c * 10), 9) / 10
+    return f"{lo:.1f}-{lo + 0.1:.1f}"
+
+def contribution_from_row(row_values: List[Any]) -> Dict[str, str]:
+    """
+    Lo que aporta una fila de Applicants a los agregados (una key por dimensión).
+    """
+    row = dict(zip(APPLICANTS_COLUMNS, row_values))
+    out = {
+        "outcome": str(row.get("outcome") or "unknown"),
+        "stage_reached": str(row.get("stage_reached") or "unknown"),
+        "dropoff_stage": str(row.get("dropoff_stage") or "none"),
+        "primary_reason_code": str(row.get("primary_reason_code") or "UNKNOWN"),
+        "needs_human_review": str(row.get("needs_human_review") in (True, "TRUE", "true", "True")).lower(),
+        "confidence_bucket": _confidence_bucket(row.get("confidence")),
+    }
+    return out
+
+class FunnelSummary:
+    """
+    Agregados del funnel por file_run_id y global, mantenidos en O(1) por análisis:
+    se guarda la contribución de cada contacto y al re-analizarlo se resta la anterior
+    antes de sumar la nueva. Se vuelca por lotes a un tab de resumen y a un JSON.
+    Asume un solo worker escribiendo el resumen. El scope global se re-sincroniza con la
+    hoja en cada recarga del snapshot de SheetSink (resync_global).
+
+    Las contribuciones por contacto se guardan para el scope global y solo para los
+    `max_open_runs` file runs más recientes; los runs más viejos quedan con sus agregados
+    congelados (un re-análisis tardío ahí se cuenta solo en el global).
+    """
+    def __init__(self, snapshot_path: Optional[str] = None, flush_every: int = 50, flush_interval_sec: float = 60.0,
+                 max_open_runs: int = 5):
+        self.snapshot_path = snapshot_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval_sec
+        self.max_open_runs = max_open_runs
+        # scope -> contact_key -> contribution
+        self.contributions: Dict[str, Dict[str, Dict[str, str]]] = {}
+        # scope -> {"total": n, dimension: {key: n}}
+        self.aggregates: Dict[str, Dict[str, Any]] = {}
+        self.dirty = 0
+        self.last_flush = time.monotonic()
+
+    def _apply(self, scope: str, contrib: Dict[str, str], sign: int):
+        agg = self.aggregates.setdefault(scope, {"total": 0})
+        agg["total"] += sign
+        for dim in DIMENSIONS:
+            counts = agg.setdefault(dim, {})
+            key = contrib.get(dim, "unknown")
+            counts[key] = counts.get(key, 0) + sign
+
+    def _replace(self, scope: str, contact_key: str, contrib: Dict[str, str]):
+        by_contact = self.contributions.setdefault(scope, {})
+        prev = by_contact.get(contact_key)
+        if prev == contrib:
+            return
+        if prev is not None:
+            self._apply(scope, prev, -1)
+        self._apply(scope, contrib, +1)
+        by_contact[contact_key] = contrib
+        self.dirty += 1
+
+    def update(self, contact_key: str, file_run_id: Optional[str], row_values: List[Any]):
+        contrib = contribution_from_row(row_values)
+        self._replace(GLOBAL_SCOPE, contact_key, contrib)
+        if not file_run_id:
+            return
+        scope = f"run:{file_run_id}"
+        # un run ya podado (agregados sin contribuciones) no se toca: no se podría restar lo anterior
+        if scope in self.aggregates and scope not in self.contributions:
+            return
+        is_new = scope not in self.contributions
+        self._replace(scope, contact_key, contrib)
+        if is_new:
+            self._prune_runs()
+
+    def _prune_runs(self):
+        # dicts mantienen orden de inserción: los primeros run: son los más viejos
+        runs = [s for s in self.contributions if s != GLOBAL_SCOPE]
+        for scope in runs[:max(0, len(runs) - self.max_open_runs)]:
+            del self.contributions[scope]
+
+    def seed_from_sheet(self, rows: Dict[str, Any]):
+        """
+        Arranque sin snapshot: arma el scope global desde el snapshot de SheetSink
+        (phone -> (row, values)), sin leer la hoja de nuevo.
+        """
+        for phone, (_, values) in rows.items():
+            self._replace(GLOBAL_SCOPE, phone, contribution_from_row(values))
+
+    def resync_global(self, rows: Dict[str, Any]):
+        """
+        Alinea el scope global con el snapshot de SheetSink: corrige updates que se perdieron
+        por una caída entre el ack y el flush. Los scopes run: no se re-sincronizan.
+        """
+        by_contact = self.contributions.setdefault(GLOBAL_SCOPE, {})
+        for contact_key in [k for k in by_contact if k not in rows]:
+            self._apply(GLOBAL_SCOPE, by_contact.pop(contact_key), -1)
+            self.dirty += 1
+        self.seed_from_sheet(rows)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "updated_at": utc_now_iso(),
+            "aggregates": self.aggregates,
+            "contributions": self.contributions,
+        }
+
+    def load(self, obj: Dict[str, Any]):
+        self.aggregates = obj.get("aggregates", {})
+        self.contributions = obj.get("contributions", {})
+        self._prune_runs()
+
+    def load_local(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        with open(self.snapshot_path, "rb") as f:
+            self.load(json_loads(f.read()))
+        return True
+
+    def summary_rows(self) -> List[List[Any]]:
+        ts = utc_now_iso()
+        rows = [SUMMARY_HEADER]
+        # global primero, luego runs en orden
+        for scope in sorted(self.aggregates, key=lambda s: (s != GLOBAL_SCOPE, s)):
+            agg = self.aggregates[scope]
+            rows.append([scope, "total", "", agg.get("total", 0), ts])
+            for dim in DIMENSIONS:
+                for key, n in sorted(agg.get(dim, {}).items()):
+                    rows.append([scope, dim, key, n, ts])
+        return rows
+
+    def maybe_flush(self, sink: SheetSink, spreadsheet_id: str, sheet_name: str, force: bool = False, ds=None, drive_file_id: Optional[str] = None):
+        """
+        Vuelca si hay cambios y se juntaron `flush_every` o pasó `flush_interval`.
+        """
+        if not self.dirty:
+            return
+        due = self.dirty >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval
+        if not (force or due):
+            return
+
+        data = json_dumpb(self.to_dict())
+        if self.snapshot_path:
+            if os.path.dirname(self.snapshot_path):
+                os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.snapshot_path)
+        if ds and drive_file_id:
+            ds.update_file_json(drive_file_id, data)
+        sink.write_summary(spreadsheet_id, sheet_name, self.summary_rows())
+
+        self.dirty = 0
+        self.last_flush = time.monotonic()
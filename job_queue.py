@@ -0,0 +1,282 @@
+# job_queue.py
+from __future__ import annotations
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from drive_store import DriveStore
+from tracing import span
+from utils import utc_now_iso, json_dumpb, json_loads
+
+class ClaimedJob:
+    def __init__(self, name: str, job: Dict[str, Any], handle: Any, claimed_at: Optional[float] = None):
+        self.name = name
+        self.job = job
+        # id del backend (file_id en Drive, name en SQLite)
+        self.handle = handle
+        # token del claim: un ack/nack tardío de un claim vencido no pisa al claim nuevo
+        self.claimed_at = claimed_at
+
+class JobQueue(ABC):
+    """
+    Interfaz de cola: enqueue_many / claim_batch / ack / nack (con delay) / dead_letter.
+    claim_batch ya incrementa job["attempt"] y deja status="processing".
+    """
+    @abstractmethod
+    def enqueue_many(self, jobs: List[Tuple[str, Dict[str, Any]]]) -> int:
+        ...
+
+    @abstractmethod
+    def claim_batch(self, n: int) -> List[ClaimedJob]:
+        ...
+
+    @abstractmethod
+    def ack(self, claimed: ClaimedJob):
+        ...
+
+    @abstractmethod
+    def nack(self, claimed: ClaimedJob, delay_sec: float = 0.0):
+        ...
+
+    @abstractmethod
+    def dead_letter(self, claimed: ClaimedJob):
+        ...
+
+def _start_attempt(job: Dict[str, Any]) -> Dict[str, Any]:
+    job["attempt"] = int(job.get("attempt", 0)) + 1
+    job["status"] = "processing"
+    job["updated_at"] = utc_now_iso()
+    return job
+
+class DriveFolderQueue(JobQueue):
+    """
+    La cola original sobre carpetas de Drive: pending -> processing (move = lock) -> done/error.
+    El delay de nack va en appProperties.not_before del archivo; claim_batch pagina pending
+    hasta juntar `n` jobs listos, así los demorados al frente no tapan a los de atrás.
+    Los archivos que quedan en processing más de `visibility_timeout_sec` (worker caído a
+    mitad de un batch) vuelven a pending en un barrido cada `sweep_interval_sec`. A diferencia de SQLite, Drive no tiene
+    token de claim: un ack tardío de un claim vencido gana (last writer wins).
+    """
+    def __init__(self, ds: DriveStore, pending: str, processing: str, done: str, error: str, scan_limit: int = 25,
+                 visibility_timeout_sec: float = 900.0, sweep_interval_sec: float = 60.0):
+        self.ds = ds
+        self.pending = pending
+        self.processing = processing
+        self.done = done
+        self.error = error
+        self.scan_limit = scan_limit
+        self.visibility_timeout = visibility_timeout_sec
+        self.sweep_interval = sweep_interval_sec
+        self.last_sweep = 0.0
+
+    def _sweep_stale(self):
+        now = time.time()
+        if now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        for f in self.ds.list_files(self.processing, limit=self.scan_limit):
+            # el claim hace update_file_json, así que modifiedTime ~ momento del claim
+            modified = datetime.fromisoformat(f["modifiedTime"].replace("Z", "+00:00")).timestamp()
+            if now - modified <= self.visibility_timeout:
+                continue
+            try:
+                self.ds.move_file(f["id"], self.pending)
+            except Exception:
+                continue
+
+    def enqueue_many(self, jobs: List[Tuple[str, Dict[str, Any]]]) -> int:
+        n = 0
+        for name, job in jobs:
+            # prevent duplicate job for same name
+            if self.ds.find_by_name(self.pending, name):
+                continue
+            self.ds.upload_json(self.pending, name, json_dumpb(job))
+            n += 1
+        return n
+
+    def claim_batch(self, n: int) -> List[ClaimedJob]:
+        self._sweep_stale()
+        out: List[ClaimedJob] = []
+        now = time.time()
+        for f in self.ds.iter_files(self.pending, page_size=max(n, self.scan_limit)):
+            if len(out) >= n:
+                break
+            not_before = (f.get("appProperties") or {}).get("not_before")
+            if not_before and float(not_before) > now:
+                continue
+            try:
+                # move = claim lock
+                self.ds.move_file(f["id"], self.processing)
+            except Exception:
+                continue
+            job = _start_attempt(json_loads(self.ds.download_bytes(f["id"])))
+            self.ds.update_file_json(f["id"], json_dumpb(job))
+            out.append(ClaimedJob(f["name"], job, f["id"]))
+        return out
+
+    def ack(self, claimed: ClaimedJob):
+        self.ds.update_file_json(claimed.handle, json_dumpb(claimed.job))
+        self.ds.move_file(claimed.handle, self.done)
+
+    def nack(self, claimed: ClaimedJob, delay_sec: float = 0.0):
+        try:
+            self.ds.update_file_json(claimed.handle, json_dumpb(claimed.job))
+        except Exception:
+            pass
+        props = {"not_before": str(time.time() + delay_sec)} if delay_sec > 0 else None
+        # requeue
+        self.ds.move_file(claimed.handle, self.pending, app_properties=props)
+
+    def dead_letter(self, claimed: ClaimedJob):
+        try:
+            self.ds.update_file_json(claimed.handle, json_dumpb(claimed.job))
+        except Exception:
+            pass
+        self.ds.move_file(claimed.handle, self.error)
+
+class SQLiteQueue(JobQueue):
+    """
+    Cola local durable en SQLite (WAL). Las operaciones son transacciones locales, así que
+    claim/ack cuestan microsegundos en lugar de 6-8 llamadas a Drive. Un job en processing
+    por más de `visibility_timeout_sec` (worker caído) vuelve a ser reclamable. Los jobs done
+    se borran pasados `done_retention_sec` (barrido cada `purge_interval_sec`); los dead quedan.
+    """
+    def __init__(self, path: str, name: str = "jobs", visibility_timeout_sec: float = 900.0,
+                 done_retention_sec: float = 7 * 86400.0, purge_interval_sec: float = 3600.0):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.name = name
+        self.visibility_timeout = visibility_timeout_sec
+        self.done_retention = done_retention_sec
+        self.purge_interval = purge_interval_sec
+        self.last_purge = 0.0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " queue TEXT NOT NULL, name TEXT NOT NULL, payload BLOB NOT NULL,"
+            " status TEXT NOT NULL, attempt INTEGER NOT NULL DEFAULT 0,"
+            " available_at REAL NOT NULL, claimed_at REAL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (queue, name))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (queue, status, available_at)"
+        )
+
+    def enqueue_many(self, jobs: List[Tuple[str, Dict[str, Any]]]) -> int:
+        now = time.time()
+        with span("queue.enqueue_many", backend="sqlite", queue=self.name, count=len(jobs)), self.lock:
+            before = self.conn.total_changes
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO jobs (queue, name, payload, status, attempt, available_at, updated_at)"
+                    " VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+                    [(self.name, name, json_dumpb(job), int(job.get("attempt", 0)), now, now) for name, job in jobs],
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return self.conn.total_changes - before
+
+    def _purge_done(self):
+        now = time.time()
+        if now - self.last_purge < self.purge_interval:
+            return
+        self.last_purge = now
+        with span("queue.purge_done", backend="sqlite", queue=self.name) as sp, self.lock:
+            cur = self.conn.execute(
+                "DELETE FROM jobs WHERE queue = ? AND status = 'done' AND updated_at < ?",
+                (self.name, now - self.done_retention),
+            )
+            sp.set("count", cur.rowcount)
+
+    def claim_batch(self, n: int) -> List[ClaimedJob]:
+        self._purge_done()
+        now = time.time()
+        with span("queue.claim_batch", backend="sqlite", queue=self.name) as sp, self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "SELECT name, payload FROM jobs WHERE queue = ? AND ("
+                    " (status = 'pending' AND available_at <= ?)"
+                    " OR (status = 'processing' AND claimed_at < ?))"
+                    " ORDER BY available_at LIMIT ?",
+                    (self.name, now, now - self.visibility_timeout, n),
+                ).fetchall()
+                out = []
+                for name, payload in rows:
+                    job = _start_attempt(json_loads(payload))
+                    self.conn.execute(
+                        "UPDATE jobs SET status = 'processing', payload = ?, attempt = ?, claimed_at = ?, updated_at = ?"
+                        " WHERE queue = ? AND name = ?",
+                        (json_dumpb(job), job["attempt"], now, now, self.name, name),
+                    )
+                    out.append(ClaimedJob(name, job, name, claimed_at=now))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            sp.set("count", len(out))
+            return out
+
+    def _finish(self, claimed: ClaimedJob, status: str, available_at: Optional[float] = None) -> bool:
+        """
+        Cierra el claim solo si sigue siendo el vigente; devuelve False si el job ya fue
+        reclamado por otro worker tras el visibility timeout (el resultado tardío se descarta).
+        """
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute(
+                "UPDATE jobs SET status = ?, payload = ?, attempt = ?, available_at = COALESCE(?, available_at),"
+                " claimed_at = NULL, updated_at = ?"
+                " WHERE queue = ? AND name = ? AND status = 'processing' AND claimed_at = ?",
+                (status, json_dumpb(claimed.job), int(claimed.job.get("attempt", 0)), available_at, now,
+                 self.name, claimed.handle, claimed.claimed_at),
+            )
+            return cur.rowcount > 0
+
+    def ack(self, claimed: ClaimedJob):
+        return self._finish(claimed, "done")
+
+    def nack(self, claimed: ClaimedJob, delay_sec: float = 0.0):
+        return self._finish(claimed, "pending", available_at=time.time() + delay_sec)
+
+    def dead_letter(self, claimed: ClaimedJob):
+        return self._finish(claimed, "dead")
+
+def entry_queue_name(cfg: dict) -> str:
+    # con pipeline.staged el scheduler alimenta la etapa fetch; si no, la cola única "jobs"
+    return "fetch" if cfg.get("pipeline", {}).get("staged") else "jobs"
+
+def make_queue(cfg: dict, ds: Optional[DriveStore] = None, name: str = "jobs") -> JobQueue:
+    """
+    Backend según cfg["queue"]["backend"]: "drive" (default, carpetas queue_*) o "sqlite".
+    `name` separa colas: "jobs" usa queue_pending/..., una etapa usa queue_<etapa>_pending/...
+    """
+    Q = cfg.get("queue", {})
+    backend = Q.get("backend", "drive")
+    if backend == "sqlite":
+        return SQLiteQueue(
+            Q.get("sqlite_path", "data/queue.sqlite3"),
+            name=name,
+            visibility_timeout_sec=float(Q.get("visibility_timeout_sec", 900.0)),
+            done_retention_sec=float(Q.get("done_retention_sec", 7 * 86400.0)),
+        )
+    if backend == "drive":
+        F = cfg["drive"]["folders"]
+        prefix = "queue_" if name == "jobs" else f"queue_{name}_"
+        return DriveFolderQueue(
+            ds or DriveStore(cfg["service_account_json"]),
+            F[prefix + "pending"], F[prefix + "processing"], F[prefix + "done"], F[prefix + "error"],
+            scan_limit=int(cfg.get("runtime", {}).get("worker_claim_limit", 25)),
+            visibility_timeout_sec=float(Q.get("visibility_timeout_sec", 900.0)),
+        )
+    raise ValueError(f"queue.backend desconocido: {backend}")
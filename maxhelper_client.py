@@ -1,5 +1,7 @@
 import time, threading, requests
 
+from tracing import span
+
 class TokenBucket:
     def __init__(self, rate_per_sec: float, capacity: int):
         self.rate = rate_per_sec
@@ -28,15 +30,19 @@ class MaxHelperClient:
         self.bucket = bucket
 
     def _get(self, path: str, params=None):
-        self.bucket.consume(1)
-        r = self.s.get(f"{self.base}{path}", params=params, timeout=30)
-        # backoff simple en 429/5xx
-        if r.status_code in (429, 500, 502, 503, 504):
-            time.sleep(1.5)
+        with span("maxhelper.get", path=path) as sp:
             self.bucket.consume(1)
             r = self.s.get(f"{self.base}{path}", params=params, timeout=30)
-        r.raise_for_status()
-        return r.json()
+            # backoff simple en 429/5xx
+            if r.status_code in (429, 500, 502, 503, 504):
+                sp.set("retry_status", r.status_code)
+                time.sleep(1.5)
+                self.bucket.consume(1)
+                r = self.s.get(f"{self.base}{path}", params=params, timeout=30)
+            sp.set("status", r.status_code)
+            sp.set("bytes", len(r.content))
+            r.raise_for_status()
+            return r.json()
 
     def contact_by_number(self, number_digits: str):
         return self._get(f"/contacts/by-number/{number_digits}")
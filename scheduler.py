@@ -1,10 +1,13 @@
 # scheduler.py
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 import openpyxl
 
 from drive_store import DriveStore
-from utils import utc_now_iso, normalize_phone, json_dumps
+from job_queue import JobQueue, make_queue, entry_queue_name
+from utils import utc_now_iso, normalize_phone, json_dumpb
 
 def load_config():
     with open("config.json", "r", encoding="utf-8") as f:
@@ -59,79 +62,108 @@ def read_xlsx_contacts(xlsx_bytes: bytes):
         deduped.append(c)
     return deduped
 
+def process_file(ds: DriveStore, queue: JobQueue, F: dict, f: dict) -> str:
+    """
+    Procesa un XLSX del inbox: index (processing) -> download -> parse -> jobs -> archive -> index (done).
+    Devuelve el status final ("skipped", "done" o "error").
+    """
+    drive_file_id = f["id"]
+    name = f["name"]
+
+    # Idempotency: if index file exists, skip (already seen)
+    index_name = f"{drive_file_id}.json"
+    existing = ds.find_by_name(F["index_files"], index_name)
+    if existing:
+        return "skipped"
+
+    # Create a run id for this file
+    file_run_id = f"{drive_file_id}__{utc_now_iso().replace(':','-')}"
+    idx_obj = {
+        "drive_file_id": drive_file_id,
+        "name": name,
+        "status": "processing",
+        "file_run_id": file_run_id,
+        "created_at": utc_now_iso(),
+    }
+
+    # Create index (processing)
+    idx_file_id = ds.upload_json(F["index_files"], index_name, json_dumpb(idx_obj))
+
+    try:
+        # Download + parse XLSX
+        xlsx_bytes = ds.download_bytes(drive_file_id)
+        contacts = read_xlsx_contacts(xlsx_bytes)
+
+        # Create a job per contact (el backend ignora nombres duplicados)
+        jobs = []
+        for c in contacts:
+            job_name = f"{c['phone']}__{file_run_id}.json"
+            job_obj = {
+                "contact_key": c["phone"],
+                "name": c["name"],
+                "email": c["email"],
+                "file_run_id": file_run_id,
+                "attempt": 0,
+                "created_at": utc_now_iso(),
+                "status": "pending",
+            }
+            jobs.append((job_name, job_obj))
+        idx_obj["jobs_enqueued"] = queue.enqueue_many(jobs)
+
+        # Move XLSX to archive
+        ds.move_file(drive_file_id, F["archive_xlsx"])
+
+        # Mark index as done
+        idx_obj["status"] = "done"
+        idx_obj["processed_at"] = utc_now_iso()
+        ds.update_file_json(idx_file_id, json_dumpb(idx_obj))
+        return "done"
+
+    except Exception as e:
+        # Mark index as error
+        idx_obj["status"] = "error"
+        idx_obj["error"] = str(e)
+        idx_obj["processed_at"] = utc_now_iso()
+        ds.update_file_json(idx_file_id, json_dumpb(idx_obj))
+        return "error"
+
 def main():
     cfg = load_config()
-    ds = DriveStore(cfg["service_account_json"])
     F = cfg["drive"]["folders"]
 
-    batch_limit = int(cfg.get("runtime", {}).get("scheduler_batch_limit", 10))
+    runtime = cfg.get("runtime", {})
+    batch_limit = int(runtime.get("scheduler_batch_limit", 10))
+    concurrency = max(1, int(runtime.get("scheduler_concurrency", 4)))
 
-    # List XLSX files in inbox folder
-    inbox_files = ds.list_files(F["inbox_xlsx"], limit=batch_limit)
+    # El cliente de googleapiclient no es thread-safe: un DriveStore por thread.
+    local = threading.local()
 
-    for f in inbox_files:
-        drive_file_id = f["id"]
-        name = f["name"]
+    def drive_store() -> DriveStore:
+        if not hasattr(local, "ds"):
+            local.ds = DriveStore(cfg["service_account_json"])
+        return local.ds
 
-        # Idempotency: if index file exists, skip (already seen)
-        index_name = f"{drive_file_id}.json"
-        existing = ds.find_by_name(F["index_files"], index_name)
-        if existing:
-            continue
+    def job_queue() -> JobQueue:
+        if not hasattr(local, "queue"):
+            local.queue = make_queue(cfg, drive_store(), entry_queue_name(cfg))
+        return local.queue
 
-        # Create a run id for this file
-        file_run_id = f"{drive_file_id}__{utc_now_iso().replace(':','-')}"
-        idx_obj = {
-            "drive_file_id": drive_file_id,
-            "name": name,
-            "status": "processing",
-            "file_run_id": file_run_id,
-            "created_at": utc_now_iso(),
-        }
-
-        # Create index (processing)
-        idx_file_id = ds.upload_json(F["index_files"], index_name, json_dumps(idx_obj))
-
-        try:
-            # Download + parse XLSX
-            xlsx_bytes = ds.download_bytes(drive_file_id)
-            contacts = read_xlsx_contacts(xlsx_bytes)
-
-            # Create a job per contact in queue/pending
-            for c in contacts:
-                job_name = f"{c['phone']}__{file_run_id}.json"
-
-                # Optional: prevent duplicate job for same phone+run
-                if ds.find_by_name(F["queue_pending"], job_name):
-                    continue
-
-                job_obj = {
-                    "contact_key": c["phone"],
-                    "name": c["name"],
-                    "email": c["email"],
-                    "file_run_id": file_run_id,
-                    "attempt": 0,
-                    "created_at": utc_now_iso(),
-                    "status": "pending",
-                }
-                ds.upload_json(F["queue_pending"], job_name, json_dumps(job_obj))
-
-            # Move XLSX to archive
-            ds.move_file(drive_file_id, F["archive_xlsx"])
-
-            # Mark index as done
-            idx_obj["status"] = "done"
-            idx_obj["processed_at"] = utc_now_iso()
-            ds.update_file_json(idx_file_id, json_dumps(idx_obj))
-
-        except Exception as e:
-            # Mark index as error
-            idx_obj["status"] = "error"
-            idx_obj["error"] = str(e)
-            idx_obj["processed_at"] = utc_now_iso()
-            ds.update_file_json(idx_file_id, json_dumps(idx_obj))
-            # Don't crash the whole scheduler; continue with next file
-            continue
+    # List XLSX files in inbox folder
+    inbox_files = drive_store().list_files(F["inbox_xlsx"], limit=batch_limit)
+    if not inbox_files:
+        return
+
+    # Pipeline con concurrencia acotada: mientras un archivo se parsea/encola,
+    # otros ya se están descargando. Cada archivo es independiente y su index
+    # en index_files se crea antes de tocarlo, así que la idempotencia se mantiene.
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(inbox_files))) as pool:
+        futures = [pool.submit(lambda f=f: process_file(drive_store(), job_queue(), F, f)) for f in inbox_files]
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception:
+                # Don't crash the whole scheduler; continue with next file
+                continue
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,13 @@
 from __future__ import annotations
-from typing import Dict, Any, List
+import re
+import time
+from typing import Dict, Any, List, Optional, Tuple
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 
+from tracing import span
+from utils import normalize_phone
+
 APPLICANTS_COLUMNS = [
   "applicant_id","name","phone","email",
   "outcome","stage_reached","dropoff_stage",
@@ -14,6 +19,26 @@ APPLICANTS_COLUMNS = [
   "analysis_ts"
 ]
 
+PHONE_COL = APPLICANTS_COLUMNS.index("phone")
+# recarga periódica del snapshot: HR puede ordenar o borrar filas a mano
+DEFAULT_SNAPSHOT_TTL_SEC = 300.0
+# columnas que cambian en cada análisis aunque el resultado sea el mismo
+DIFF_IGNORE_COLUMNS = {"analysis_ts"}
+
+def _col_letter(i: int) -> str:
+    # 0 -> A, 25 -> Z, 26 -> AA
+    out = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        out = chr(65 + r) + out
+    return out
+
+def _norm_row(values: List[Any]) -> List[Any]:
+    # Sheets omite celdas vacías al final y devuelve "" en lugar de None
+    vals = ["" if v is None else v for v in values[:len(APPLICANTS_COLUMNS)]]
+    return vals + [""] * (len(APPLICANTS_COLUMNS) - len(vals))
+
 class SheetSink:
     def __init__(self, service_account_json: str):
         creds = service_account.Credentials.from_service_account_file(
@@ -21,6 +46,10 @@ class SheetSink:
             scopes=["https://www.googleapis.com/auth/spreadsheets"],
         )
         self.sheets = build("sheets", "v4", credentials=creds, cache_discovery=False)
+        # snapshot en memoria: phone -> (row_num, values)
+        self.rows: Dict[str, Tuple[int, List[Any]]] = {}
+        self.snapshot_loaded_at: Optional[float] = None
+        self.snapshot_ttl_sec: Optional[float] = DEFAULT_SNAPSHOT_TTL_SEC
 
     def ensure_header(self, spreadsheet_id: str, sheet_name: str):
         rng = f"{sheet_name}!A1:Z1"
@@ -38,17 +67,17 @@ class SheetSink:
 
     def append_row(self, spreadsheet_id: str, sheet_name: str, row_values: List[Any]) -> int:
         # append returns updatedRange like 'Aplicantes!A137:Z137'
-        resp = self.sheets.spreadsheets().values().append(
-            spreadsheetId=spreadsheet_id,
-            range=f"{sheet_name}!A:Z",
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values":[row_values]}
-        ).execute()
+        with span("sheets.append_row", sheet=sheet_name):
+            resp = self.sheets.spreadsheets().values().append(
+                spreadsheetId=spreadsheet_id,
+                range=f"{sheet_name}!A:Z",
+                valueInputOption="RAW",
+                insertDataOption="INSERT_ROWS",
+                body={"values":[row_values]}
+            ).execute()
         updated_range = resp.get("updates", {}).get("updatedRange", "")
         # parse row number
         # e.g. Aplicantes!A137:Z137
-        import re
         m = re.search(r"!A(\d+):", updated_range)
         return int(m.group(1)) if m else -1
 
@@ -60,3 +89,139 @@ class SheetSink:
             valueInputOption="RAW",
             body={"values":[row_values]}
         ).execute()
+
+    def load_snapshot(self, spreadsheet_id: str, sheet_name: str):
+        """
+        Lee toda la hoja en un solo values().get y arma el mapa phone -> (row, values).
+        """
+        with span("sheets.load_snapshot", sheet=sheet_name) as sp:
+            resp = self.sheets.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=f"{sheet_name}!A:Z",
+                valueRenderOption="UNFORMATTED_VALUE"
+            ).execute()
+            sp.set("rows", len(resp.get("values", [])))
+        rows: Dict[str, Tuple[int, List[Any]]] = {}
+        for i, vals in enumerate(resp.get("values", [])[1:], start=2):
+            vals = _norm_row(vals)
+            phone = normalize_phone(vals[PHONE_COL])
+            if phone:
+                rows[phone] = (i, vals)
+        self.rows = rows
+        self.snapshot_loaded_at = time.monotonic()
+
+    def _snapshot_stale(self) -> bool:
+        if self.snapshot_loaded_at is None:
+            return True
+        if self.snapshot_ttl_sec is None:
+            return False
+        return time.monotonic() - self.snapshot_loaded_at > self.snapshot_ttl_sec
+
+    def _row_has_phone(self, spreadsheet_id: str, sheet_name: str, row_num: int, phone: str) -> bool:
+        col = _col_letter(PHONE_COL)
+        with span("sheets.verify_row", sheet=sheet_name, row=row_num):
+            resp = self.sheets.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=f"{sheet_name}!{col}{row_num}",
+                valueRenderOption="UNFORMATTED_VALUE"
+            ).execute()
+        vals = resp.get("values", [])
+        return bool(vals and vals[0]) and normalize_phone(vals[0][0]) == phone
+
+    def _read_row(self, spreadsheet_id: str, sheet_name: str, row_num: int) -> List[Any]:
+        with span("sheets.read_row", sheet=sheet_name, row=row_num):
+            resp = self.sheets.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=f"{sheet_name}!A{row_num}:Z{row_num}",
+                valueRenderOption="UNFORMATTED_VALUE"
+            ).execute()
+        vals = resp.get("values", [])
+        return _norm_row(vals[0] if vals else [])
+
+    def upsert_row(self, spreadsheet_id: str, sheet_name: str, row_values: List[Any],
+                   key: Optional[str] = None, hint_row: Optional[int] = None) -> int:
+        """
+        Upsert por teléfono usando el snapshot: escribe solo las celdas que cambiaron
+        (nada si solo cambió analysis_ts) o hace append si el teléfono no está.
+        `key` es el teléfono (por defecto el de la fila; debe coincidir con la columna phone).
+        `hint_row` es la fila que dice el index de Drive: si no coincide con el snapshot se lee
+        esa fila y, si es de este teléfono, se hace el diff contra ella; si no, se recarga el
+        snapshot y manda la hoja. Antes de escribir celdas sueltas se verifica que la fila
+        destino siga siendo de ese teléfono. Devuelve el número de fila.
+        """
+        if self._snapshot_stale():
+            self.load_snapshot(spreadsheet_id, sheet_name)
+
+        new_vals = _norm_row(row_values)
+        phone = normalize_phone(key or new_vals[PHONE_COL])
+        entry = self.rows.get(phone) if phone else None
+        verified = False
+        if hint_row and phone and (not entry or entry[0] != hint_row):
+            # el index de Drive y el snapshot no coinciden: manda la hoja
+            vals = self._read_row(spreadsheet_id, sheet_name, hint_row)
+            if normalize_phone(vals[PHONE_COL]) == phone:
+                entry = self.rows[phone] = (hint_row, vals)
+            else:
+                self.load_snapshot(spreadsheet_id, sheet_name)
+                entry = self.rows.get(phone)
+            verified = True
+
+        while True:
+            if not entry:
+                row_num = self.append_row(spreadsheet_id, sheet_name, new_vals)
+                if row_num > 0 and phone:
+                    self.rows[phone] = (row_num, new_vals)
+                return row_num
+
+            row_num, old_vals = entry
+            changed = [i for i, (a, b) in enumerate(zip(old_vals, new_vals)) if a != b]
+            if all(APPLICANTS_COLUMNS[i] in DIFF_IGNORE_COLUMNS for i in changed):
+                return row_num
+            if verified or self._row_has_phone(spreadsheet_id, sheet_name, row_num, phone):
+                break
+            # la fila ya no es de este teléfono (orden/borrado manual): recargar y recalcular
+            self.load_snapshot(spreadsheet_id, sheet_name)
+            entry = self.rows.get(phone)
+            verified = True
+
+        # agrupa celdas cambiadas contiguas en rangos
+        data = []
+        start = prev = changed[0]
+        for i in changed[1:] + [None]:
+            if i is not None and i == prev + 1:
+                prev = i
+                continue
+            data.append({
+                "range": f"{sheet_name}!{_col_letter(start)}{row_num}:{_col_letter(prev)}{row_num}",
+                "values": [new_vals[start:prev + 1]]
+            })
+            if i is not None:
+                start = prev = i
+        with span("sheets.batch_update", sheet=sheet_name, row=row_num, cells=len(changed)):
+            self.sheets.spreadsheets().values().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={"valueInputOption": "RAW", "data": data}
+            ).execute()
+        self.rows[phone] = (row_num, new_vals)
+        return row_num
+
+    def ensure_sheet(self, spreadsheet_id: str, sheet_name: str):
+        meta = self.sheets.spreadsheets().get(
+            spreadsheetId=spreadsheet_id, fields="sheets.properties.title"
+        ).execute()
+        titles = [s["properties"]["title"] for s in meta.get("sheets", [])]
+        if sheet_name not in titles:
+            self.sheets.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={"requests":[{"addSheet": {"properties": {"title": sheet_name}}}]}
+            ).execute()
+
+    def write_summary(self, spreadsheet_id: str, sheet_name: str, rows: List[List[Any]]):
+        # el resumen solo crece (las keys en 0 se conservan), así que basta sobrescribir desde A1
+        with span("sheets.write_summary", sheet=sheet_name, rows=len(rows)):
+            self.sheets.spreadsheets().values().update(
+                spreadsheetId=spreadsheet_id,
+                range=f"{sheet_name}!A1",
+                valueInputOption="RAW",
+                body={"values": rows}
+            ).execute()
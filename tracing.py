@@ -0,0 +1,221 @@
+# tracing.py
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from utils import json_dumps, utc_now_iso
+
+def _attr_value(v: Any) -> Dict[str, Any]:
+    # OTLP/JSON AnyValue (int64 va como string)
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": "" if v is None else str(v)}
+
+def _attrs(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": k, "value": _attr_value(v)} for k, v in d.items()]
+
+class _NoopSpan:
+    def set(self, key: str, value: Any):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attrs: Dict[str, Any], start_ns: Optional[int] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attrs = dict(attrs)
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any):
+        self.attrs[key] = value
+
+    def set_error(self, message: str):
+        # para errores que se manejan dentro del span (la excepción no lo atraviesa)
+        self.error = message
+
+    def to_otlp(self) -> Dict[str, Any]:
+        out = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": _attrs(self.attrs),
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            out["parentSpanId"] = self.parent_id
+        return out
+
+class Tracer:
+    """
+    Spans por job exportados como OTLP/JSON: una línea ExportTraceServiceRequest por trace,
+    a un archivo local (JSON lines) y/o a la carpeta logs_runs de Drive.
+    """
+    def __init__(self, service_name: str, path: Optional[str] = None, ds=None, drive_folder_id: Optional[str] = None):
+        self.service_name = service_name
+        self.path = path
+        self.ds = ds
+        self.drive_folder_id = drive_folder_id
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # el DriveStore del export se comparte entre threads y googleapiclient no es thread-safe
+        self.export_lock = threading.Lock()
+        self.finished: Dict[str, List[Span]] = {}
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name: str, start_ns: Optional[int] = None, root: bool = False, **attrs):
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        if getattr(self.local, "exporting", False) or (parent is None and not root):
+            # fuera de un job (polls vacíos, el propio export) no se tracea
+            yield _NoopSpan()
+            return
+        trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        sp = Span(name, trace_id, parent.span_id if parent else None, attrs, start_ns=start_ns)
+        stack.append(sp)
+        try:
+            yield sp
+        except BaseException as e:
+            sp.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            sp.end_ns = time.time_ns()
+            with self.lock:
+                self.finished.setdefault(trace_id, []).append(sp)
+            if parent is None:
+                self._export(trace_id)
+
+    def record(self, name: str, start_ns: int, end_ns: int, **attrs):
+        # span ya medido (p.ej. el claim, que ocurre antes de abrir el span del job)
+        stack = self._stack()
+        if not stack:
+            return
+        parent = stack[-1]
+        sp = Span(name, parent.trace_id, parent.span_id, attrs, start_ns=start_ns)
+        sp.end_ns = end_ns
+        with self.lock:
+            self.finished.setdefault(parent.trace_id, []).append(sp)
+
+    def _export(self, trace_id: str):
+        with self.lock:
+            spans = self.finished.pop(trace_id, [])
+        if not spans:
+            return
+        line = json_dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": _attrs({"service.name": self.service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": "rrhh.pipeline"},
+                    "spans": [s.to_otlp() for s in spans],
+                }],
+            }]
+        })
+        # exportar nunca debe tumbar un job
+        self.local.exporting = True
+        try:
+            if self.path:
+                with self.lock, open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            if self.ds and self.drive_folder_id:
+                with self.export_lock:
+                    self.ds.upload_json(self.drive_folder_id, f"trace__{trace_id}.json", line)
+        except Exception:
+            pass
+        finally:
+            self.local.exporting = False
+
+_tracer: Optional[Tracer] = None
+
+def set_tracer(tracer: Optional[Tracer]):
+    global _tracer
+    _tracer = tracer
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Span sobre el tracer global; no-op si el tracing no está configurado o si no hay
+    un span padre abierto (salvo root=True, que abre un trace nuevo).
+    """
+    if _tracer is None:
+        yield _NoopSpan()
+        return
+    with _tracer.span(name, **attrs) as sp:
+        yield sp
+
+def record_span(name: str, start_ns: int, end_ns: int, **attrs):
+    if _tracer is not None:
+        _tracer.record(name, start_ns, end_ns, **attrs)
+
+# un solo job perfilado a la vez: tracemalloc es global al proceso y los threads de etapa
+# lo apagarían mientras otro job todavía lo está usando
+_profile_lock = threading.Lock()
+
+@contextmanager
+def maybe_profile(sample_rate: float, out_dir: Optional[str], label: str, top_n: int = 40):
+    """
+    Con probabilidad `sample_rate` corre el bloque bajo cProfile + tracemalloc y deja en
+    `out_dir` un .prof (para snakeviz/pstats) y un .txt con top de CPU y de allocations.
+    Si otro thread ya está perfilando, el job corre sin profiler.
+    """
+    if not out_dir or sample_rate <= 0 or random.random() >= sample_rate:
+        yield
+        return
+    if not _profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    try:
+        own_tracemalloc = not tracemalloc.is_tracing()
+        if own_tracemalloc:
+            tracemalloc.start(10)
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            # el profiler nunca debe tumbar un job
+            try:
+                snap = tracemalloc.take_snapshot()
+                os.makedirs(out_dir, exist_ok=True)
+                base = os.path.join(out_dir, f"{label}__{utc_now_iso().replace(':', '-')}")
+                prof.dump_stats(base + ".prof")
+                buf = io.StringIO()
+                pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(top_n)
+                buf.write("\n--- top allocations (tracemalloc, by line) ---\n")
+                for stat in snap.statistics("lineno")[:top_n]:
+                    buf.write(f"{stat}\n")
+                with open(base + ".txt", "w", encoding="utf-8") as f:
+                    f.write(buf.getvalue())
+            except Exception:
+                pass
+            finally:
+                if own_tracemalloc:
+                    tracemalloc.stop()
+    finally:
+        _profile_lock.release()
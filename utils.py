@@ -1,6 +1,12 @@
 import json
 import hashlib
 from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List
+
+try:
+    import orjson
+except ImportError:  # opcional: sin orjson se usa json de la stdlib
+    orjson = None
 
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
@@ -14,8 +20,126 @@ def normalize_phone(raw: str) -> str | None:
     digits = "".join(ch for ch in str(raw) if ch.isdigit())
     return digits or None
 
+def json_dumpb(obj) -> bytes:
+    """
+    Serializa a bytes UTF-8 (lo que suben Drive/SQLite), con orjson si está disponible.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # p.ej. enteros > 64 bits: la stdlib sí los soporta
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 def json_dumps(obj) -> str:
+    if orjson is not None:
+        return json_dumpb(obj).decode("utf-8")
     return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
 
-def json_loads(s: str):
+def json_loads(s: str | bytes):
+    # acepta bytes directo de download_bytes, sin .decode("utf-8") previo
+    if orjson is not None:
+        return orjson.loads(s)
     return json.loads(s)
+
+_JSON_TYPES: Dict[str, Callable[[Any], bool]] = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+}
+
+def compile_schema(schema: Dict[str, Any]) -> Callable[[Any], List[str]]:
+    """
+    Compila (una vez) el subconjunto de JSON Schema que usamos: type, enum, properties,
+    required, additionalProperties, items, minimum/maximum, maxItems.
+    Devuelve validate(obj) -> lista de errores (vacía si es válido).
+    """
+    def _compile(node: Dict[str, Any]):
+        checks = []
+
+        types = node.get("type")
+        if types is not None:
+            type_fns = [_JSON_TYPES[t] for t in ([types] if isinstance(types, str) else types)]
+            expected = types if isinstance(types, str) else "|".join(types)
+
+            def check_type(v, path, errors):
+                if not any(fn(v) for fn in type_fns):
+                    errors.append(f"{path}: se esperaba {expected}, vino {type(v).__name__}")
+                    return False
+                return True
+            checks.append(check_type)
+
+        if "enum" in node:
+            allowed = frozenset(node["enum"])
+
+            def check_enum(v, path, errors):
+                if v not in allowed:
+                    errors.append(f"{path}: {v!r} no está en enum")
+                    return False
+                return True
+            checks.append(check_enum)
+
+        if "minimum" in node or "maximum" in node:
+            lo, hi = node.get("minimum"), node.get("maximum")
+
+            def check_range(v, path, errors):
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    if (lo is not None and v < lo) or (hi is not None and v > hi):
+                        errors.append(f"{path}: {v} fuera de rango [{lo}, {hi}]")
+                return True
+            checks.append(check_range)
+
+        if "properties" in node or "required" in node:
+            props = {k: _compile(sub) for k, sub in node.get("properties", {}).items()}
+            required = list(node.get("required", []))
+            closed = node.get("additionalProperties") is False
+
+            def check_object(v, path, errors):
+                if not isinstance(v, dict):
+                    return True
+                for k in required:
+                    if k not in v:
+                        errors.append(f"{path}.{k}: requerido")
+                for k, sub_v in v.items():
+                    fn = props.get(k)
+                    if fn is not None:
+                        fn(sub_v, f"{path}.{k}", errors)
+                    elif closed:
+                        errors.append(f"{path}.{k}: propiedad no permitida")
+                return True
+            checks.append(check_object)
+
+        if "items" in node or "maxItems" in node:
+            item_fn = _compile(node["items"]) if "items" in node else None
+            max_items = node.get("maxItems")
+
+            def check_array(v, path, errors):
+                if not isinstance(v, list):
+                    return True
+                if max_items is not None and len(v) > max_items:
+                    errors.append(f"{path}: más de {max_items} items")
+                if item_fn is not None:
+                    for i, item in enumerate(v):
+                        item_fn(item, f"{path}[{i}]", errors)
+                return True
+            checks.append(check_array)
+
+        def validate_node(v, path, errors):
+            for check in checks:
+                # si falla type/enum no tiene sentido seguir bajando
+                if not check(v, path, errors):
+                    return
+        return validate_node
+
+    root = _compile(schema)
+
+    def validate(obj: Any) -> List[str]:
+        errors: List[str] = []
+        root(obj, "$", errors)
+        return errors
+    return validate
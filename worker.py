@@ -1,10 +1,15 @@
+import argparse
 import json
+import threading
 import time
 from drive_store import DriveStore
 from maxhelper_client import MaxHelperClient, TokenBucket
-from sheet_sink import SheetSink, APPLICANTS_COLUMNS
-from utils import utc_now_iso, json_dumps, json_loads
-from analyzer_gemini import GeminiAnalyzer
+from sheet_sink import SheetSink, APPLICANTS_COLUMNS, PHONE_COL, DEFAULT_SNAPSHOT_TTL_SEC
+from utils import utc_now_iso, json_dumpb, json_loads
+from analyzer_gemini import GeminiAnalyzer, AdaptiveLimiter, AdaptiveGeminiAnalyzer
+from funnel_summary import FunnelSummary
+from job_queue import make_queue, entry_queue_name
+from tracing import Tracer, set_tracer, span, record_span, maybe_profile
 
 
 def load_config():
@@ -16,23 +21,23 @@ def get_contact_cache(ds: DriveStore, folder_id: str, contact_key: str):
     f = ds.find_by_name(folder_id, name)
     if not f:
         return None
-    data = ds.download_bytes(f["id"]).decode("utf-8")
+    data = ds.download_bytes(f["id"])
     return json_loads(data)
 
 def set_contact_cache(ds: DriveStore, folder_id: str, contact_key: str, obj):
     name = f"{contact_key}.json"
     existing = ds.find_by_name(folder_id, name)
     if existing:
-        ds.update_file_json(existing["id"], json_dumps(obj))
+        ds.update_file_json(existing["id"], json_dumpb(obj))
     else:
-        ds.upload_json(folder_id, name, json_dumps(obj))
+        ds.upload_json(folder_id, name, json_dumpb(obj))
 
 def get_sheet_row_index(ds: DriveStore, folder_id: str, contact_key: str):
     name = f"{contact_key}.json"
     f = ds.find_by_name(folder_id, name)
     if not f:
         return None
-    data = ds.download_bytes(f["id"]).decode("utf-8")
+    data = ds.download_bytes(f["id"])
     return json_loads(data)
 
 def set_sheet_row_index(ds: DriveStore, folder_id: str, contact_key: str, row: int):
@@ -40,9 +45,34 @@ def set_sheet_row_index(ds: DriveStore, folder_id: str, contact_key: str, row: i
     name = f"{contact_key}.json"
     existing = ds.find_by_name(folder_id, name)
     if existing:
-        ds.update_file_json(existing["id"], json_dumps(obj))
+        ds.update_file_json(existing["id"], json_dumpb(obj))
     else:
-        ds.upload_json(folder_id, name, json_dumps(obj))
+        ds.upload_json(folder_id, name, json_dumpb(obj))
+
+def init_funnel_summary(cfg: dict, ds: DriveStore, sink: SheetSink):
+    """
+    Carga los agregados del funnel (JSON local -> JSON en logs_runs) y alinea el scope global con el
+    snapshot de la hoja; sin JSON, el global sale entero de la hoja. Devuelve (summary, drive_file_id del JSON).
+    """
+    F = cfg["drive"]["folders"]
+    R = cfg["runtime"]
+    summary = FunnelSummary(
+        snapshot_path=R.get("funnel_snapshot_path", "data/funnel_summary.json"),
+        flush_every=int(R.get("funnel_flush_every", 50)),
+        flush_interval_sec=float(R.get("funnel_flush_interval_sec", 60.0)),
+        max_open_runs=int(R.get("funnel_max_open_runs", 5)),
+    )
+    sink.ensure_sheet(cfg["sheets"]["spreadsheet_id"], cfg["sheets"].get("sheet_summary", "Resumen"))
+
+    existing = ds.find_by_name(F["logs_runs"], "funnel_summary.json")
+    if summary.load_local():
+        pass
+    elif existing:
+        summary.load(json_loads(ds.download_bytes(existing["id"])))
+    summary.resync_global(sink.rows)
+
+    drive_file_id = existing["id"] if existing else ds.upload_json(F["logs_runs"], "funnel_summary.json", json_dumpb(summary.to_dict()))
+    return summary, drive_file_id
 
 def flatten_analysis_to_row(analysis: dict) -> list:
     # mapea el JSON estándar a columnas de sheet
@@ -145,121 +175,310 @@ def make_analysis_mvp(job: dict, messages_raw: dict) -> dict:
         "meta": {"model": "mvp-rules", "analysis_ts": utc_now_iso()}
     }
 
-def claim_one_job(ds: DriveStore, pending_folder: str, processing_folder: str, limit: int):
-    jobs = ds.list_files(pending_folder, limit=limit)
-    for f in jobs:
-        try:
-            # move = claim lock
-            ds.move_file(f["id"], processing_folder)
-            return f  # claimed
-        except Exception:
-            continue
-    return None
+STAGES = ["fetch", "analyze", "publish"]
 
-def main():
-    cfg = load_config()
-    F = cfg["drive"]["folders"]
-    ds = DriveStore(cfg["service_account_json"])
-
-    # Sheets client
-    sink = SheetSink(cfg["service_account_json"])
-    sink.ensure_header(cfg["sheets"]["spreadsheet_id"], cfg["sheets"]["sheet_applicants"])
-
-    # MaxHelper client + rate limit
-    bucket = TokenBucket(rate_per_sec=100/60, capacity=100)
-    mh = MaxHelperClient(cfg["maxhelper"]["base_url"], cfg["maxhelper"]["api_key"], bucket)
+def build_analyzer(cfg: dict) -> AdaptiveGeminiAnalyzer:
     analyzer = GeminiAnalyzer(model=cfg.get("openai", {}).get("model", "gemini-1.5-flash"))
     # (si preferís, crea un bloque cfg["gemini"]["model"])
 
+    # Gemini: concurrencia adaptativa (AIMD) + retries con jitter
+    G = cfg.get("gemini", {})
+    limiter = AdaptiveLimiter(
+        initial=int(G.get("initial_concurrency", 2)),
+        min_limit=int(G.get("min_concurrency", 1)),
+        max_limit=int(G.get("max_concurrency", 16)),
+        latency_target_sec=float(G.get("latency_target_sec", 20.0)),
+    )
+    return AdaptiveGeminiAnalyzer(
+        analyzer, limiter,
+        max_retries=int(G.get("max_retries", 4)),
+        backoff_base_sec=float(G.get("backoff_base_sec", 1.0)),
+    )
+
+def build_maxhelper(cfg: dict, bucket: TokenBucket | None = None) -> MaxHelperClient:
+    # MaxHelper client + rate limit (el bucket se comparte entre threads, la Session no)
+    if bucket is None:
+        bucket = TokenBucket(rate_per_sec=100/60, capacity=100)
+    return MaxHelperClient(cfg["maxhelper"]["base_url"], cfg["maxhelper"]["api_key"], bucket)
+
+class Publisher:
+    """
+    Sheets + agregados del funnel. El snapshot de SheetSink y FunnelSummary son de un solo
+    escritor, así que un Publisher se usa desde un único thread.
+    """
+    def __init__(self, cfg: dict, ds: DriveStore):
+        self.cfg = cfg
+        self.spreadsheet_id = cfg["sheets"]["spreadsheet_id"]
+        self.sheet_applicants = cfg["sheets"]["sheet_applicants"]
+        self.sheet_summary = cfg["sheets"].get("sheet_summary", "Resumen")
+        self.ds = ds
+
+        # Sheets client
+        self.sink = SheetSink(cfg["service_account_json"])
+        self.sink.ensure_header(self.spreadsheet_id, self.sheet_applicants)
+        snapshot_ttl = cfg["runtime"].get("sheet_snapshot_ttl_sec", DEFAULT_SNAPSHOT_TTL_SEC)
+        self.sink.snapshot_ttl_sec = float(snapshot_ttl) if snapshot_ttl else None
+        self.sink.load_snapshot(self.spreadsheet_id, self.sheet_applicants)
+
+        # Agregados del funnel (incrementales, volcados por lotes)
+        self.summary, self.summary_file_id = init_funnel_summary(cfg, ds, self.sink)
+        self.synced_snapshot_at = self.sink.snapshot_loaded_at
+
+    def publish(self, ds: DriveStore, job: dict, analysis: dict):
+        F = self.cfg["drive"]["folders"]
+        contact_key = job["contact_key"]
 
-    max_attempts = cfg["runtime"]["max_attempts"]
+        # upsert to Sheets (diff contra el snapshot; el index de Drive es solo un hint)
+        row_values = flatten_analysis_to_row(analysis)
+        # la hoja se indexa por contact_key: contact.phone de Gemini puede venir null o distinto
+        row_values[PHONE_COL] = contact_key
+
+        idx = get_sheet_row_index(ds, F["index_sheet_rows"], contact_key)
+        hint_row = int(idx["row"]) if idx and idx.get("row") else None
+        row_num = self.sink.upsert_row(self.spreadsheet_id, self.sheet_applicants, row_values, key=contact_key, hint_row=hint_row)
+        if row_num > 0 and row_num != hint_row:
+            set_sheet_row_index(ds, F["index_sheet_rows"], contact_key, row_num)
+
+        # agregados del funnel (reemplaza la contribución previa del contacto)
+        self.summary.update(contact_key, job["file_run_id"], row_values)
+        if self.sink.snapshot_loaded_at != self.synced_snapshot_at:
+            # snapshot recargado (TTL o desajuste): el global vuelve a coincidir con la hoja
+            self.summary.resync_global(self.sink.rows)
+            self.synced_snapshot_at = self.sink.snapshot_loaded_at
+        self.flush()
+
+    def flush(self, force: bool = False):
+        try:
+            self.summary.maybe_flush(self.sink, self.spreadsheet_id, self.sheet_summary, force=force,
+                                     ds=self.ds, drive_file_id=self.summary_file_id)
+        except Exception:
+            # el resumen no debe frenar jobs; se reintenta en el próximo flush
+            pass
+
+def fetch_messages(ds: DriveStore, F: dict, mh: MaxHelperClient, job: dict):
+    """
+    contact_id (cacheado en index_contacts) + mensajes de MaxHelper, escritos en Bronze.
+    Devuelve (messages_raw, bronze_file_id).
+    """
+    contact_key = job["contact_key"]
+
+    # 1) contact_id cache
+    cache = get_contact_cache(ds, F["index_contacts"], contact_key)
+    contact_id = cache.get("maxhelper_contact_id") if cache else None
+
+    if not contact_id:
+        c = mh.contact_by_number(contact_key)
+        contact_id = str(c.get("id") or c.get("contact", {}).get("id") or "")
+        if contact_id:
+            set_contact_cache(ds, F["index_contacts"], contact_key, {
+                "contact_key": contact_key,
+                "maxhelper_contact_id": contact_id,
+                "updated_at": utc_now_iso()
+            })
+
+    # 2) messages
+    messages_raw = []
+    if contact_id:
+        messages_raw = mh.messages(contact_id)
+
+    # write Bronze
+    bronze_name = f"{contact_key}__{job['file_run_id']}.json"
+    bronze_file_id = ds.upload_json(F["bronze_messages_raw"], bronze_name, json_dumpb({
+        "contact_key": contact_key,
+        "maxhelper_contact_id": contact_id,
+        "fetched_at": utc_now_iso(),
+        "messages_raw": messages_raw
+    }))
+    return messages_raw, bronze_file_id
+
+def analyze_messages(ds: DriveStore, F: dict, analyzer: AdaptiveGeminiAnalyzer, job: dict, messages_raw):
+    """
+    Análisis con Gemini, escrito en Silver. Devuelve (analysis, silver_file_id).
+    """
+    analysis = analyzer.analyze(job, messages_raw)
+
+    # write Silver
+    silver_name = f"{job['contact_key']}__{job['file_run_id']}.json"
+    silver_file_id = ds.upload_json(F["silver_analysis"], silver_name, json_dumpb(analysis))
+    return analysis, silver_file_id
+
+def next_stage_job(job: dict, **refs) -> dict:
+    out = {k: job.get(k) for k in ("contact_key", "name", "email", "file_run_id")}
+    out.update(refs)
+    out.update({"attempt": 0, "created_at": utc_now_iso(), "status": "pending"})
+    return out
+
+def run_queue_loop(cfg: dict, queue, handler, policy: dict, span_name: str, on_idle=None, before_claim=None):
+    """
+    Loop genérico: claim_batch -> handler(job) -> ack, o nack con backoff / dead_letter
+    según la política de retries (max_attempts, retry_base_delay_sec, claim_batch).
+    `before_claim` bloquea hasta que convenga reclamar (p.ej. capacidad en el limiter de Gemini).
+    """
+    T = cfg.get("tracing", {})
+    profile_rate = float(T.get("profile_sample_rate", 0.0))
+    profile_dir = T.get("profile_dir")
+
+    max_attempts = int(policy.get("max_attempts", cfg["runtime"]["max_attempts"]))
+    retry_base_delay = float(policy.get("retry_base_delay_sec", cfg["runtime"].get("retry_base_delay_sec", 0.0)))
+    claim_batch = int(policy.get("claim_batch", cfg.get("queue", {}).get("claim_batch", 1)))
 
     while True:
-        claimed = claim_one_job(ds, F["queue_pending"], F["queue_processing"], cfg["runtime"]["worker_claim_limit"])
-        if not claimed:
+        if before_claim:
+            before_claim()
+        claim_start_ns = time.time_ns()
+        claims = queue.claim_batch(claim_batch)
+        if not claims:
+            if on_idle:
+                on_idle()
             time.sleep(2.0)
             continue
 
-        job_file_id = claimed["id"]
-        job_name = claimed["name"]
+        claim_end_ns = time.time_ns()
+
+        for k, claimed in enumerate(claims):
+            job = claimed.job
+
+            # el claim del batch se atribuye solo al primer job; el resto arranca cuando empieza
+            with span(span_name, root=True, start_ns=claim_start_ns if k == 0 else None, job_name=claimed.name,
+                      contact_key=job["contact_key"], file_run_id=job.get("file_run_id", ""),
+                      attempt=job["attempt"], batch_index=k) as job_span, \
+                    maybe_profile(profile_rate, profile_dir, f"{span_name}__{claimed.name}"):
+                if k == 0:
+                    record_span("queue.claim", claim_start_ns, claim_end_ns, batch=len(claims))
+                try:
+                    handler(job)
+
+                    # done
+                    job["status"] = "done"
+                    job["done_at"] = utc_now_iso()
+                    queue.ack(claimed)
+
+                except Exception as e:
+                    job_span.set("error", str(e))
+                    job_span.set_error(f"{type(e).__name__}: {e}")
+                    job["status"] = "error"
+                    job["last_error"] = str(e)
+                    job["updated_at"] = utc_now_iso()
+
+                    if job.get("attempt", 1) >= max_attempts:
+                        queue.dead_letter(claimed)
+                    else:
+                        # requeue con backoff exponencial
+                        queue.nack(claimed, delay_sec=retry_base_delay * (2 ** (job["attempt"] - 1)))
+
+def run_monolithic(cfg: dict):
+    """
+    --stage all: fetch -> analyze -> publish en una sola iteración sobre la cola "jobs".
+    """
+    F = cfg["drive"]["folders"]
+    ds = DriveStore(cfg["service_account_json"])
+    publisher = Publisher(cfg, ds)
+    mh = build_maxhelper(cfg)
+    analyzer = build_analyzer(cfg)
+
+    def handle(job: dict):
+        messages_raw, _ = fetch_messages(ds, F, mh, job)
+        analysis, _ = analyze_messages(ds, F, analyzer, job, messages_raw)
+        publisher.publish(ds, job, analysis)
+        job["gemini_metrics"] = analyzer.metrics()
+
+    run_queue_loop(cfg, make_queue(cfg, ds), handle, {}, "job", on_idle=lambda: publisher.flush(force=True))
+
+def run_stages(cfg: dict, stages: list):
+    """
+    Etapas desacopladas, cada una con su cola (fetch -> analyze -> publish), su concurrencia
+    y su política de retries en cfg["stages"][<etapa>]. Los handoffs van por Bronze/Silver:
+    el job de la etapa siguiente lleva el file id en Drive. En analyze cada thread reclama
+    solo cuando el AdaptiveLimiter tiene lugar, así no retiene jobs mientras Gemini lo frena.
+    """
+    F = cfg["drive"]["folders"]
+    S = cfg.get("stages", {})
+    # un solo rate limit de MaxHelper para todos los threads de fetch
+    bucket = TokenBucket(rate_per_sec=100/60, capacity=100)
+    analyzer = build_analyzer(cfg) if "analyze" in stages else None
+    publisher = Publisher(cfg, DriveStore(cfg["service_account_json"])) if "publish" in stages else None
+
+    def stage_loop(stage: str):
+        # googleapiclient no es thread-safe: DriveStore y colas por thread
+        ds = DriveStore(cfg["service_account_json"])
+        queue = make_queue(cfg, ds, stage)
+        nxt = STAGES.index(stage) + 1
+        next_queue = make_queue(cfg, ds, STAGES[nxt]) if nxt < len(STAGES) else None
+        # requests.Session tampoco se comparte entre threads
+        mh = build_maxhelper(cfg, bucket) if stage == "fetch" else None
+
+        def handle_fetch(job: dict):
+            _, bronze_file_id = fetch_messages(ds, F, mh, job)
+            name = f"{job['contact_key']}__{job['file_run_id']}.json"
+            next_queue.enqueue_many([(name, next_stage_job(job, bronze_file_id=bronze_file_id))])
+
+        def handle_analyze(job: dict):
+            bronze = json_loads(ds.download_bytes(job["bronze_file_id"]))
+            _, silver_file_id = analyze_messages(ds, F, analyzer, job, bronze.get("messages_raw", []))
+            job["gemini_metrics"] = analyzer.metrics()
+            name = f"{job['contact_key']}__{job['file_run_id']}.json"
+            next_queue.enqueue_many([(name, next_stage_job(job, silver_file_id=silver_file_id))])
+
+        def handle_publish(job: dict):
+            analysis = json_loads(ds.download_bytes(job["silver_file_id"]))
+            publisher.publish(ds, job, analysis)
+
+        handler = {"fetch": handle_fetch, "analyze": handle_analyze, "publish": handle_publish}[stage]
+        on_idle = (lambda: publisher.flush(force=True)) if stage == "publish" else None
+        before_claim = analyzer.limiter.wait_capacity if stage == "analyze" else None
+        run_queue_loop(cfg, queue, handler, S.get(stage, {}), f"stage.{stage}", on_idle=on_idle, before_claim=before_claim)
+
+    threads = []
+    for stage in stages:
+        if stage == "publish":
+            # siempre 1 thread (snapshot de la hoja y resumen son de un solo escritor)
+            n = 1
+        else:
+            n = max(1, int(S.get(stage, {}).get("concurrency", 1)))
+        for i in range(n):
+            t = threading.Thread(target=stage_loop, args=(stage,), name=f"{stage}-{i}", daemon=True)
+            t.start()
+            threads.append(t)
+    # si una etapa se cae, salimos para que el restart policy levante el proceso entero
+    while all(t.is_alive() for t in threads):
+        time.sleep(5.0)
+    dead = [t.name for t in threads if not t.is_alive()]
+    raise SystemExit(f"etapas caídas: {', '.join(dead)}")
 
-        # load job json
-        job = json_loads(ds.download_bytes(job_file_id).decode("utf-8"))
-        contact_key = job["contact_key"]
+def main():
+    parser = argparse.ArgumentParser(description="Worker del pipeline RRHH")
+    parser.add_argument(
+        "--stage", action="append", choices=["all"] + STAGES,
+        help="etapa a correr (repetible). 'all' (default) = fetch+analyze+publish en una sola iteración por job",
+    )
+    args = parser.parse_args()
+    stages = args.stage or ["all"]
 
-        try:
-            # attempt
-            job["attempt"] = int(job.get("attempt", 0)) + 1
-            job["status"] = "processing"
-            job["updated_at"] = utc_now_iso()
-            ds.update_file_json(job_file_id, json_dumps(job))
-
-            # 1) contact_id cache
-            cache = get_contact_cache(ds, F["index_contacts"], contact_key)
-            contact_id = cache.get("maxhelper_contact_id") if cache else None
-
-            if not contact_id:
-                c = mh.contact_by_number(contact_key)
-                contact_id = str(c.get("id") or c.get("contact", {}).get("id") or "")
-                if contact_id:
-                    set_contact_cache(ds, F["index_contacts"], contact_key, {
-                        "contact_key": contact_key,
-                        "maxhelper_contact_id": contact_id,
-                        "updated_at": utc_now_iso()
-                    })
-
-            # 2) messages
-            messages_raw = []
-            if contact_id:
-                messages_raw = mh.messages(contact_id)
-
-            # write Bronze
-            bronze_name = f"{contact_key}__{job['file_run_id']}.json"
-            ds.upload_json(F["bronze_messages_raw"], bronze_name, json_dumps({
-                "contact_key": contact_key,
-                "maxhelper_contact_id": contact_id,
-                "fetched_at": utc_now_iso(),
-                "messages_raw": messages_raw
-            }))
-
-            # 3) analysis (Gemini)
-            analysis = analyzer.analyze(job, messages_raw)
-
-            # write Silver
-            silver_name = f"{contact_key}__{job['file_run_id']}.json"
-            ds.upload_json(F["silver_analysis"], silver_name, json_dumps(analysis))
-
-            # 4) upsert to Sheets (by row index cached in Drive)
-            row_values = flatten_analysis_to_row(analysis)
-
-            idx = get_sheet_row_index(ds, F["index_sheet_rows"], contact_key)
-            if idx and idx.get("row"):
-                sink.update_row(cfg["sheets"]["spreadsheet_id"], cfg["sheets"]["sheet_applicants"], int(idx["row"]), row_values)
-            else:
-                row_num = sink.append_row(cfg["sheets"]["spreadsheet_id"], cfg["sheets"]["sheet_applicants"], row_values)
-                if row_num > 0:
-                    set_sheet_row_index(ds, F["index_sheet_rows"], contact_key, row_num)
-
-            # done
-            job["status"] = "done"
-            job["done_at"] = utc_now_iso()
-            ds.update_file_json(job_file_id, json_dumps(job))
-            ds.move_file(job_file_id, F["queue_done"])
-
-        except Exception as e:
-            job["status"] = "error"
-            job["last_error"] = str(e)
-            job["updated_at"] = utc_now_iso()
-            try:
-                ds.update_file_json(job_file_id, json_dumps(job))
-            except Exception:
-                pass
-
-            if job.get("attempt", 1) >= max_attempts:
-                ds.move_file(job_file_id, F["queue_error"])
-            else:
-                # requeue
-                ds.move_file(job_file_id, F["queue_pending"])
+    cfg = load_config()
+    F = cfg["drive"]["folders"]
+
+    # Tracing por job (OTLP/JSON lines) + profiler opcional sobre una fracción de jobs
+    T = cfg.get("tracing", {})
+    if T.get("enabled"):
+        set_tracer(Tracer(
+            "rrhh-worker",
+            path=T.get("path"),
+            ds=DriveStore(cfg["service_account_json"]) if T.get("export_to_drive") else None,
+            drive_folder_id=F.get("logs_runs"),
+        ))
+
+    if stages == ["all"]:
+        if entry_queue_name(cfg) != "jobs":
+            # el scheduler alimenta la cola fetch: --stage all sobre "jobs" nunca vería un job
+            parser.error("pipeline.staged está activo: correr --stage fetch/analyze/publish en lugar de --stage all")
+        run_monolithic(cfg)
+    elif "all" in stages:
+        parser.error("--stage all no se combina con otras etapas")
+    elif entry_queue_name(cfg) != "fetch":
+        # sin pipeline.staged el scheduler alimenta "jobs": las colas de etapa quedarían vacías
+        parser.error("pipeline.staged no está activo: correr --stage all o activar pipeline.staged")
+    else:
+        run_stages(cfg, list(dict.fromkeys(stages)))
 
 if __name__ == "__main__":
     main()